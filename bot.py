@@ -1,21 +1,31 @@
 import logging
-import random
+import hashlib
+import html
 import string
-import sqlite3
 import sys
 import asyncio
 import os
-import json
+import struct
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import aiosqlite
 from dotenv import load_dotenv
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
 
-from telegram import Update, BotCommand, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from telegram import Update, BotCommand, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
+    CallbackQueryHandler,
     MessageHandler,
     filters,
-    ContextTypes,
-    JobQueue
+    ContextTypes
 )
 from telegram.constants import ParseMode
 from telegram.error import Conflict, BadRequest, TimedOut
@@ -25,6 +35,24 @@ load_dotenv()
 TOKEN = os.getenv("TOKEN")
 CHANNEL_ID_STR = os.getenv("CHANNEL_ID")
 DB_NAME = "file_storage.db"
+DB_READERS = 4
+COMMANDS_HASH_FILE = ".commands_hash"
+LIST_PAGE_SIZE = 20
+# 列表里每条备注最多显示的字符数；Telegram 按实体解析后的文本计 4096 字符上限，20 条截断后的备注远低于该上限
+LIST_NOTE_PREVIEW = 80
+# 页码上限，过大的页码会让 OFFSET 超出 SQLite 整数范围
+LIST_MAX_PAGE = 100000
+# 同时进行的频道请求上限，多个用户同时上传时平滑请求速率，避免触发 429
+CHANNEL_CONCURRENCY = 20
+# 上传/转发文件较慢，普通 API 请求的读写超时放宽；连接池沿用 PTB 默认的 256
+HTTP_TIMEOUT = 30
+KEY_CACHE_SIZE = 1024
+# 同一媒体组的消息通常在几百毫秒内陆续到达
+BATCH_DEBOUNCE_SECONDS = 1.5
+KEY_LENGTH = 8
+KEY_CHARSET = string.ascii_letters + string.digits
+# 密钥冲突时重新生成的最大次数
+KEY_INSERT_ATTEMPTS = 5
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
@@ -40,13 +68,79 @@ except (ValueError, TypeError):
     logger.error("错误：.env 文件中的 CHANNEL_ID 必须是一个有效的整数。")
     sys.exit(1)
 
+# --- SQL 语句 ---
+# 所有连接都是长连接，sqlite3 按语句文本缓存已编译的语句，集中定义保证各处文本一致
+SQL_INSERT_FILE = "INSERT INTO files (user_id, file_type, file_id, key, original_name, custom_note, channel_msg_id) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO NOTHING RETURNING id"
+SQL_SELECT_BY_KEY = "SELECT file_type, file_id, custom_note FROM files WHERE key = ?"
+SQL_LIST_BY_USER = "SELECT key, custom_note FROM files WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?"
+# 所有权校验直接写在 WHERE 里，RETURNING 为空即表示文件不存在或不属于该用户（需要 SQLite 3.35+）
+SQL_UPDATE_NOTE_OWNED = "UPDATE files SET custom_note = ? WHERE key = ? AND user_id = ? RETURNING channel_msg_id, file_type"
+SQL_DELETE_OWNED = "DELETE FROM files WHERE key = ? AND user_id = ? RETURNING channel_msg_id"
+
 # --- 数据库和工具函数 ---
-def init_db():
-    conn = None
+class DBPool:
+    """一个读写连接 + N 个只读连接。写操作串行执行，读操作借助 WAL 与写操作并发。"""
+
+    def __init__(self, writer, readers):
+        self._writer = writer
+        self._write_lock = asyncio.Lock()
+        self._all_readers = readers
+        self._readers = asyncio.Queue()
+        for reader in readers:
+            self._readers.put_nowait(reader)
+
+    @asynccontextmanager
+    async def reader(self):
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                # 出错时回滚，避免共享连接停留在未提交的事务中
+                await self._writer.rollback()
+                raise
+
+    async def close(self):
+        for reader in self._all_readers:
+            await reader.close()
+        await self._writer.close()
+
+async def _connect(database, **kwargs):
+    db = await aiosqlite.connect(database, cached_statements=256, **kwargs)
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")
+    await db.execute("PRAGMA mmap_size=268435456")
+    return db
+
+async def open_db_pool():
+    writer = await _connect(DB_NAME)
+    # page_size 只在新建数据库时生效，对已有数据库无影响
+    await writer.execute("PRAGMA page_size=8192")
+    await writer.execute("PRAGMA journal_mode=WAL")
+    await writer.execute("PRAGMA synchronous=NORMAL")
+    if not await init_db(writer):
+        await writer.close()
+        return None
+    readers = [await _connect_reader() for _ in range(DB_READERS)]
+    return DBPool(writer, readers)
+
+async def _connect_reader():
+    db = await _connect(f"file:{DB_NAME}?mode=ro", uri=True)
+    await db.execute("PRAGMA query_only=1")
+    # 读连接有多个，各自的页缓存调小一些，避免总内存随 DB_READERS 成倍增长
+    await db.execute("PRAGMA cache_size=-10000")
+    return db
+
+async def init_db(db):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("""
+        await db.execute("""
         CREATE TABLE IF NOT EXISTS files (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -58,19 +152,73 @@ def init_db():
             channel_msg_id INTEGER
         )
         """)
-        conn.commit()
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_files_user ON files(user_id, id DESC)")
+        await db.execute("ANALYZE files")
+        await db.commit()
         logger.info("数据库初始化完成")
         return True
-    except sqlite3.Error as e:
+    except aiosqlite.Error as e:
         logger.error(f"数据库初始化失败: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+
+# 密钥 -> (file_type, file_id, custom_note) 的 LRU 缓存，由 update_note / delete_key 负责失效
+_key_cache = OrderedDict()
+_key_cache_epoch = 0
+
+async def _lookup_key(pool, key):
+    row = _key_cache.get(key)
+    if row is not None:
+        _key_cache.move_to_end(key)
+        return row
+    epoch = _key_cache_epoch
+    async with pool.reader() as db:
+        async with db.execute(SQL_SELECT_BY_KEY, (key,)) as cursor:
+            row = await cursor.fetchone()
+    # 查询期间若有缓存失效，这次读到的结果可能已过期，不写入缓存
+    if row is not None and epoch == _key_cache_epoch:
+        _key_cache[key] = row
+        if len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return row
+
+def _invalidate_key(key):
+    global _key_cache_epoch
+    _key_cache_epoch += 1
+    _key_cache.pop(key, None)
+
+# 62 * 4 = 248：丢弃 >= 248 的字节后再取模，保证每个字符等概率
+_KEY_BYTE_LIMIT = len(KEY_CHARSET) * (256 // len(KEY_CHARSET))
 
 def generate_key():
-    charset = string.ascii_letters + string.digits
-    return ''.join(random.choices(charset, k=8))
+    while True:
+        key = ''.join(KEY_CHARSET[b % len(KEY_CHARSET)] for b in os.urandom(KEY_LENGTH + 4) if b < _KEY_BYTE_LIMIT)
+        if len(key) >= KEY_LENGTH:
+            return key[:KEY_LENGTH]
+
+# --- 消息模板 ---
+KEY_CAPTION_TMPL = "🔑 Key: <code>{}</code>"
+CAPTION_TMPL = "🔑 Key: <code>{}</code>\n📝 Note: {}"
+KEY_INFO_TMPL = "🔑 密钥: <code>{}</code>\n📝 备注: {}"
+HELP_TEXT = (
+    "👋 您好 {}!\n\n"
+    "📁 我是文件存储机器人，我的功能:\n\n"
+    "1. 发送图片/视频/文档给我，我会存储它们并生成一个密钥🔑\n"
+    "   (如果一次发送多张图片/视频，会共用一个密钥)\n"
+    "2. 发送密钥给我，我会返回对应的文件\n"
+    "3. 使用 /list [页码] 查看您的文件列表\n"
+    "4. 使用 /update [密钥] [新备注] 修改文件备注\n"
+    "5. 使用 /delete [密钥] 删除一个文件\n\n"
+    "例如：/update ABC12345 项目最终版本"
+)
+
+# 备注来自用户输入，放进 HTML 消息前必须转义；密钥只含字母数字，无需转义
+def _format_caption(key, note=None):
+    if note is None:
+        return KEY_CAPTION_TMPL.format(key)
+    return CAPTION_TMPL.format(key, html.escape(note, quote=False))
+
+def _format_key_info(key, note):
+    return KEY_INFO_TMPL.format(key, html.escape(note, quote=False))
 
 # --- 异步的启动任务 ---
 async def check_channel_connection(application: Application):
@@ -89,65 +237,125 @@ async def set_bot_commands(application: Application):
         BotCommand("update", "修改文件备注"),
         BotCommand("delete", "删除一个文件"),
     ]
+    # 命令列表（连同 bot id）未变化时跳过这次网络请求
+    commands_hash = hashlib.blake2b(repr((application.bot.id, [(c.command, c.description) for c in commands])).encode(), digest_size=16).hexdigest()
+    if await asyncio.to_thread(_read_commands_hash) == commands_hash:
+        logger.info("机器人命令未变化，跳过设置")
+        return
     try:
         await application.bot.set_my_commands(commands)
+        await asyncio.to_thread(_write_commands_hash, commands_hash)
         logger.info("机器人命令设置成功")
     except TimedOut:
         logger.warning("设置机器人命令超时，已跳过。可能是网络问题。")
     except Exception as e:
         logger.error(f"设置机器人命令失败: {e}")
 
+def _read_commands_hash():
+    try:
+        with open(COMMANDS_HASH_FILE, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _write_commands_hash(commands_hash):
+    try:
+        with open(COMMANDS_HASH_FILE, "w", encoding="utf-8") as f:
+            f.write(commands_hash)
+    except OSError as e:
+        logger.warning(f"无法写入命令缓存文件 {COMMANDS_HASH_FILE}: {e}")
+
 async def post_init(application: Application):
-    await check_channel_connection(application)
-    await set_bot_commands(application)
+    pool = await open_db_pool()
+    if not pool:
+        raise RuntimeError("数据库初始化失败")
+    application.bot_data["db_pool"] = pool
+    # 两次 Telegram 请求互不依赖，并发执行；频道检查失败时异常照常向上抛出
+    await asyncio.gather(check_channel_connection(application), set_bot_commands(application))
+
+async def post_shutdown(application: Application):
+    pool = application.bot_data.pop("db_pool", None)
+    if pool:
+        await pool.close()
+        logger.info("数据库连接已关闭")
 
 # --- 文件批处理核心功能 ---
-async def process_file_batch(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id = job.user_id
-    chat_id = job.chat_id
+@asynccontextmanager
+async def _user_lock(context, user_id):
+    # 同一用户的文件按顺序处理，不同用户之间互不阻塞；
+    # 每把锁记录持有和等待的任务数，归零时移除，避免每个上传过的用户都留下一把锁
+    locks = context.bot_data.setdefault("user_locks", {})
+    entry = locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del locks[user_id]
 
+def _flush_batch(user_id, chat_id, context: ContextTypes.DEFAULT_TYPE):
+    # 由 loop.call_later 在防抖计时结束时调用：取出整批文件并交给后台任务处理
+    context.bot_data["user_timers"].pop(user_id, None)
     messages = context.chat_data.pop(f"file_batch_{user_id}", [])
     if not messages:
-        logger.warning(f"process_file_batch job ran for user {user_id} but no messages were found.")
+        logger.warning(f"Debounce timer for user {user_id} fired but no messages were found.")
         return
+    context.application.create_task(_process_batch_in_order(user_id, chat_id, messages, context))
 
-    is_media_group = any(msg.media_group_id for msg in messages)
-    if len(messages) == 1 and not is_media_group:
-        await _handle_single_file(messages[0], context)
-        return
+async def _process_batch_in_order(user_id, chat_id, messages, context: ContextTypes.DEFAULT_TYPE):
+    async with _user_lock(context, user_id):
+        await process_file_batch(user_id, chat_id, messages, context)
 
-    key = generate_key()
+async def process_file_batch(user_id, chat_id, messages, context: ContextTypes.DEFAULT_TYPE):
+    # 一次遍历同时得到：是否为媒体组、第一条说明文字、文件信息列表
+    is_media_group = False
+    group_note = None
     file_info_list = []
-    group_note = f"文件合集 (共 {len(messages)} 个)"
-    caption_found = False
-
     for message in messages:
-        if message.caption and not caption_found:
+        is_media_group = is_media_group or message.media_group_id is not None
+        if message.caption and group_note is None:
             group_note = message.caption
-            caption_found = True
         file_info = _extract_file_info(message)
         if file_info:
             file_info_list.append(file_info)
 
+    if len(messages) == 1 and not is_media_group:
+        await _handle_single_file(messages[0], context)
+        return
+
     if not file_info_list:
         logger.warning(f"File batch for user {user_id} had no processable files.")
         return
 
-    file_id_json = json.dumps(file_info_list)
-    db_file_id = _save_batch_to_db(user_id, file_id_json, key, group_note)
-    if not db_file_id:
-        await context.bot.send_message(chat_id=chat_id, text="❌ 文件合集保存失败，请重试。")
-        return
-    
+    key = generate_key()
+    if group_note is None:
+        group_note = f"文件合集 (共 {len(messages)} 个)"
+    # 先发到频道，再把频道消息 id 随记录一次性写入数据库
+    sent = []
     try:
-        await _send_batch_to_channel(db_file_id, key, group_note, file_info_list, context)
+        await _send_batch_to_channel(key, group_note, file_info_list, sent, context)
+        channel_ok = True
     except Exception as e:
         logger.error(f"Channel send failed for file batch {key}: {e}")
-        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ 文件合集存储成功但频道通知失败\n\n🔑 密钥: <code>{key}</code>\n📝 备注: {group_note}", parse_mode=ParseMode.HTML)
+        channel_ok = False
+
+    channel_msg_id = sent[0][0] if sent else None
+    saved_key = await _save_file_to_db(context.bot_data["db_pool"], user_id, 'batch', _pack_file_infos(file_info_list), key, "文件合集", group_note, channel_msg_id)
+    if saved_key is None:
+        await context.bot.send_message(chat_id=chat_id, text="❌ 文件合集保存失败，请重试。")
+        return
+    if saved_key != key:
+        key = saved_key
+        context.application.create_task(_relabel_channel_messages(sent, key, group_note, context))
+    logger.info(f"User {user_id} saved a file batch with key: {key}")
+
+    if not channel_ok:
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ 文件合集存储成功但频道通知失败\n\n{_format_key_info(key, group_note)}", parse_mode=ParseMode.HTML)
         return
 
-    await context.bot.send_message(chat_id=chat_id, text=f"✅ 文件合集已处理!\n\n🔑 密钥: <code>{key}</code>\n📝 备注: {group_note}\n\n您可以使用 /list 查看您的文件或 /update 修改备注", parse_mode=ParseMode.HTML)
+    await context.bot.send_message(chat_id=chat_id, text=f"✅ 文件合集已处理!\n\n{_format_key_info(key, group_note)}\n\n您可以使用 /list 查看您的文件或 /update 修改备注", parse_mode=ParseMode.HTML)
 
 # --- 辅助函数 ---
 def _extract_file_info(message):
@@ -156,59 +364,106 @@ def _extract_file_info(message):
     if message.document: return {'type': 'document', 'id': message.document.file_id}
     return None
 
-def _save_batch_to_db(user_id, file_id_json, key, note):
-    conn = None
+# 单个文件按类型发送时使用的 Bot 方法名及其文件参数名
+_SEND = {"video": ("send_video", "video"), "document": ("send_document", "document"), "photo": ("send_photo", "photo")}
+
+# 批量文件信息的二进制格式：每项为 1 字节类型 + 2 字节长度 + file_id
+_FILE_TYPE_CODES = {'photo': 0, 'video': 1, 'document': 2}
+_FILE_TYPE_NAMES = {code: name for name, code in _FILE_TYPE_CODES.items()}
+_PACK_HEADER = struct.Struct('>BH')
+
+def _pack_file_infos(file_info_list):
+    parts = []
+    for info in file_info_list:
+        raw_id = info['id'].encode()
+        parts.append(_PACK_HEADER.pack(_FILE_TYPE_CODES[info['type']], len(raw_id)))
+        parts.append(raw_id)
+    return b''.join(parts)
+
+def _unpack_file_infos(data):
+    # 旧版本以 JSON 文本存储，读取时保持兼容
+    if isinstance(data, str):
+        return json_loads(data)
+    file_info_list = []
+    offset = 0
+    while offset < len(data):
+        type_code, length = _PACK_HEADER.unpack_from(data, offset)
+        offset += _PACK_HEADER.size
+        file_info_list.append({'type': _FILE_TYPE_NAMES[type_code], 'id': data[offset:offset + length].decode()})
+        offset += length
+    return file_info_list
+
+async def _save_file_to_db(pool, user_id, file_type, file_id, key, original_name, note, channel_msg_id):
+    # 返回实际写入的密钥：与已有密钥冲突时 RETURNING 为空，换一个密钥重试；失败返回 None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO files (user_id, file_type, file_id, key, original_name, custom_note) VALUES (?, ?, ?, ?, ?, ?)",
-                       (user_id, 'batch', file_id_json, key, "文件合集", note))
-        db_file_id = cursor.lastrowid
-        conn.commit()
-        logger.info(f"User {user_id} saved a file batch with key: {key}")
-        return db_file_id
-    except sqlite3.Error as e:
-        logger.error(f"Database error for file batch {key}: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+        async with pool.writer() as db:
+            for _ in range(KEY_INSERT_ATTEMPTS):
+                async with db.execute(SQL_INSERT_FILE, (user_id, file_type, file_id, key, original_name, note, channel_msg_id)) as cursor:
+                    row = await cursor.fetchone()
+                if row:
+                    await db.commit()
+                    return key
+                logger.warning(f"Key collision for {key}, regenerating")
+                key = generate_key()
+            await db.rollback()
+        logger.error(f"Could not find a free key for {file_type} after {KEY_INSERT_ATTEMPTS} attempts")
+    except aiosqlite.Error as e:
+        logger.error(f"Database error for {file_type} {key}: {e}")
+    if channel_msg_id:
+        logger.warning(f"Channel message {channel_msg_id} for {key} was posted but has no database record")
+    return None
 
-async def _send_batch_to_channel(db_file_id, key, note, file_info_list, context):
+async def _send_batch_to_channel(key, note, file_info_list, sent, context):
+    # 已成功发出的频道消息按顺序以 (message_id, 是否带备注) 追加到 sent，中途失败时调用方仍能拿到已发出的部分
     media_group_items = [info for info in file_info_list if info['type'] in ['photo', 'video']]
     other_files = [info for info in file_info_list if info['type'] not in ['photo', 'video']]
     
     caption_sent = False
-    caption_text_func = lambda: f"🔑 Key: <code>{key}</code>\n📝 Note: {note}" if not caption_sent else f"🔑 Key: <code>{key}</code>"
 
     if media_group_items:
         media_list = []
         for item in media_group_items:
-            current_caption = f"🔑 Key: <code>{key}</code>\n📝 Note: {note}" if not caption_sent else ""
+            current_caption = _format_caption(key, note) if not caption_sent else ""
             parse_mode = ParseMode.HTML if not caption_sent else None
             if item['type'] == 'photo': media_list.append(InputMediaPhoto(media=item['id'], caption=current_caption, parse_mode=parse_mode))
             elif item['type'] == 'video': media_list.append(InputMediaVideo(media=item['id'], caption=current_caption, parse_mode=parse_mode))
             caption_sent = True
-        
-        channel_messages = await context.bot.send_media_group(chat_id=CHANNEL_ID, media=media_list)
-        _update_channel_msg_id(db_file_id, channel_messages[0].message_id)
 
+        channel_messages = await _to_channel(context.bot.send_media_group, media=media_list)
+        sent.append((channel_messages[0].message_id, True))
+
+    # 文档逐个发送，保证频道里的顺序与上传顺序及 handle_key 的返回顺序一致；没有媒体组时第一个文档带上完整说明
     for item in other_files:
-        msg = await context.bot.send_document(chat_id=CHANNEL_ID, document=item['id'], caption=caption_text_func(), parse_mode=ParseMode.HTML)
-        if not caption_sent:
-            _update_channel_msg_id(db_file_id, msg.message_id)
+        with_note = not caption_sent
+        channel_msg = await _to_channel(context.bot.send_document, document=item['id'], caption=_format_caption(key, note if with_note else None), parse_mode=ParseMode.HTML)
+        sent.append((channel_msg.message_id, with_note))
         caption_sent = True
 
-def _update_channel_msg_id(db_file_id, channel_msg_id):
-    conn = None
+_channel_semaphore = asyncio.Semaphore(CHANNEL_CONCURRENCY)
+
+async def _to_channel(method, **kwargs):
+    async with _channel_semaphore:
+        return await method(chat_id=CHANNEL_ID, **kwargs)
+
+async def _edit_channel_caption(channel_msg_id, key, note, context):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE files SET channel_msg_id = ? WHERE id = ?", (channel_msg_id, db_file_id))
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Failed to update channel_msg_id for db_id {db_file_id}: {e}")
-    finally:
-        if conn: conn.close()
+        await _to_channel(context.bot.edit_message_caption, message_id=channel_msg_id, caption=_format_caption(key, note), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.warning(f"频道备注更新失败: {e}")
+
+async def _relabel_channel_messages(sent, key, note, context):
+    # 密钥冲突重试后，已带旧密钥发出的频道消息尽力改成新密钥；在后台执行，不阻塞回复用户
+    for msg_id, with_note in sent:
+        try:
+            await _to_channel(context.bot.edit_message_caption, message_id=msg_id, caption=_format_caption(key, note if with_note else None), parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.warning(f"频道消息 {msg_id} 的密钥未能改为 {key}: {e}")
+
+async def _delete_channel_message(channel_msg_id, context):
+    try:
+        await _to_channel(context.bot.delete_message, message_id=channel_msg_id)
+    except Exception as e:
+        logger.warning(f"无法删除频道消息 {channel_msg_id} (可能已被删除或这是一个批处理): {e}")
 
 async def _handle_single_file(message, context):
     user_id = message.from_user.id
@@ -222,81 +477,76 @@ async def _handle_single_file(message, context):
     key = generate_key()
     note = message.caption or original_name
     
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO files (user_id, file_type, file_id, key, original_name, custom_note) VALUES (?, ?, ?, ?, ?, ?)",
-                       (user_id, file_type, file_id, key, original_name, note))
-        db_file_id = cursor.lastrowid
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Database error for single file {key}: {e}"); await message.reply_text("❌ 文件保存失败，请重试"); return
-    finally:
-        if conn: conn.close()
-        
+    # 先发到频道，再把频道消息 id 随记录一次性写入数据库
+    channel_msg_id = None
     try:
-        caption = f"🔑 Key: <code>{key}</code>\n📝 Note: {note}"
-        if file_type == "video": channel_msg = await context.bot.send_video(chat_id=CHANNEL_ID, video=file_id, caption=caption, parse_mode=ParseMode.HTML)
-        elif file_type == "document": channel_msg = await context.bot.send_document(chat_id=CHANNEL_ID, document=file_id, caption=caption, parse_mode=ParseMode.HTML)
-        else: channel_msg = await context.bot.send_photo(chat_id=CHANNEL_ID, photo=file_id, caption=caption, parse_mode=ParseMode.HTML)
-        _update_channel_msg_id(db_file_id, channel_msg.message_id)
+        caption = _format_caption(key, note)
+        method, file_arg = _SEND[file_type]
+        channel_msg = await _to_channel(getattr(context.bot, method), **{file_arg: file_id}, caption=caption, parse_mode=ParseMode.HTML)
+        channel_msg_id = channel_msg.message_id
     except Exception as e:
-        logger.error(f"Channel send failed for single file {key}: {e}"); await message.reply_text(f"⚠️ 文件存储成功但频道通知失败\n\n🔑 密钥: <code>{key}</code>\n📝 备注: {note}", parse_mode=ParseMode.HTML); return
-        
-    await message.reply_text(f"✅ 文件已存储!\n\n🔑 密钥: <code>{key}</code>\n📝 备注: {note}\n\n您可以使用 /list 查看您的文件或 /update 修改备注", parse_mode=ParseMode.HTML)
+        logger.error(f"Channel send failed for single file {key}: {e}")
+
+    saved_key = await _save_file_to_db(context.bot_data["db_pool"], user_id, file_type, file_id, key, original_name, note, channel_msg_id)
+    if saved_key is None:
+        await message.reply_text("❌ 文件保存失败，请重试"); return
+    if saved_key != key:
+        key = saved_key
+        if channel_msg_id:
+            context.application.create_task(_relabel_channel_messages([(channel_msg_id, True)], key, note, context))
+
+    if channel_msg_id is None:
+        await message.reply_text(f"⚠️ 文件存储成功但频道通知失败\n\n{_format_key_info(key, note)}", parse_mode=ParseMode.HTML); return
+
+    await message.reply_text(f"✅ 文件已存储!\n\n{_format_key_info(key, note)}\n\n您可以使用 /list 查看您的文件或 /update 修改备注", parse_mode=ParseMode.HTML)
 
 
 # --- 消息和命令处理器 ---
+FILE_FILTER = filters.VIDEO | filters.Document.ALL | filters.PHOTO
+KEY_FILTER = filters.TEXT & ~filters.COMMAND
+
 async def handle_any_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    job_name = f"process_batch_{user_id}"
-    if f"file_batch_{user_id}" not in context.chat_data:
-        context.chat_data[f"file_batch_{user_id}"] = []
-    context.chat_data[f"file_batch_{user_id}"].append(update.message)
-    existing_jobs = context.job_queue.get_jobs_by_name(job_name)
-    for job in existing_jobs:
-        job.schedule_removal()
-    context.job_queue.run_once(
-        process_file_batch, 5, data={}, chat_id=update.effective_chat.id, user_id=user_id, name=job_name
+    # 单个文件（非媒体组且没有待处理的批次）直接处理，无需等待
+    if update.message.media_group_id is None and not context.chat_data.get(f"file_batch_{user_id}"):
+        async with _user_lock(context, user_id):
+            await _handle_single_file(update.message, context)
+        return
+    # 追加文件与重新计时之间没有 await，_flush_batch 也是同步回调，
+    # 两者在事件循环中不会交错执行，因此这里无需加锁
+    context.chat_data.setdefault(f"file_batch_{user_id}", []).append(update.message)
+    # 每收到一个文件就重新计时
+    timers = context.bot_data.setdefault("user_timers", {})
+    handle = timers.get(user_id)
+    if handle:
+        handle.cancel()
+    timers[user_id] = asyncio.get_running_loop().call_later(
+        BATCH_DEBOUNCE_SECONDS, _flush_batch, user_id, update.effective_chat.id, context
     )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    await update.message.reply_html(
-        f"👋 您好 {user.mention_html()}!\n\n"
-        "📁 我是文件存储机器人，我的功能:\n\n"
-        "1. 发送图片/视频/文档给我，我会存储它们并生成一个密钥🔑\n"
-        "   (如果一次发送多张图片/视频，会共用一个密钥)\n"
-        "2. 发送密钥给我，我会返回对应的文件\n"
-        "3. 使用 /list 查看您的文件列表\n"
-        "4. 使用 /update [密钥] [新备注] 修改文件备注\n"
-        "5. 使用 /delete [密钥] 删除一个文件\n\n"
-        "例如：/update ABC12345 项目最终版本"
-    )
+    await update.message.reply_html(HELP_TEXT.format(user.mention_html()))
 
 async def handle_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     key = update.message.text.strip()
-    if len(key) != 8 or not all(c in (string.ascii_letters + string.digits) for c in key):
-        await update.message.reply_text("⚠️ 密钥格式错误！请输入8位字母数字组合")
+    # isascii + isalnum 等价于只含 [A-Za-z0-9]，且都在 C 层完成
+    if len(key) != KEY_LENGTH or not key.isascii() or not key.isalnum():
+        await update.message.reply_text(f"⚠️ 密钥格式错误！请输入{KEY_LENGTH}位字母数字组合")
         return
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_type, file_id, custom_note FROM files WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    conn.close()
+    result = await _lookup_key(context.bot_data["db_pool"], key)
 
     if not result:
         await update.message.reply_text("🔍 未找到匹配文件，请检查密钥是否正确")
         return
 
     file_type, file_id_data, note = result
-    caption = f"🔑 Key: <code>{key}</code>\n📝 Note: {note}"
+    caption = _format_caption(key, note)
 
     try:
         if file_type == 'batch':
-            file_info_list = json.loads(file_id_data)
+            file_info_list = _unpack_file_infos(file_id_data)
             media_group_to_send = [info for info in file_info_list if info['type'] in ['photo', 'video']]
             other_files_to_send = [info for info in file_info_list if info['type'] not in ['photo', 'video']]
             
@@ -316,34 +566,84 @@ async def handle_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await context.bot.send_document(chat_id=update.effective_chat.id, document=item['id'], caption=item_caption, parse_mode=ParseMode.HTML)
                 caption_sent = True
         else:
-            if file_type == "video": await context.bot.send_video(chat_id=update.message.chat_id, video=file_id_data, caption=caption, parse_mode=ParseMode.HTML)
-            elif file_type == "document": await context.bot.send_document(chat_id=update.message.chat_id, document=file_id_data, caption=caption, parse_mode=ParseMode.HTML)
-            else: await context.bot.send_photo(chat_id=update.message.chat_id, photo=file_id_data, caption=caption, parse_mode=ParseMode.HTML)
+            method, file_arg = _SEND[file_type]
+            await getattr(context.bot, method)(chat_id=update.message.chat_id, **{file_arg: file_id_data}, caption=caption, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"发送文件失败 (key: {key}): {e}")
         await update.message.reply_text("❌ 文件获取失败，可能文件已被Telegram后台清理。")
 
+def _preview_note(note):
+    if len(note) > LIST_NOTE_PREVIEW:
+        note = note[:LIST_NOTE_PREVIEW] + "…"
+    return html.escape(note, quote=False)
+
+async def _render_file_list(pool, user_id, page):
+    offset = (page - 1) * LIST_PAGE_SIZE
+    async with pool.reader() as db:
+        # 多取一行，用来判断是否还有下一页
+        async with db.execute(SQL_LIST_BY_USER, (user_id, LIST_PAGE_SIZE + 1, offset)) as cursor:
+            files = await cursor.fetchall()
+    if not files:
+        if page == 1:
+            return "📭 您还没有存储任何文件", None
+        # 超出范围的页码给一个回到第一页的按钮，避免停在空页上
+        return f"📭 第 {page} 页没有文件", InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ 返回第一页", callback_data=f"list:{user_id}:1")]])
+    lines = [f"{idx}. 🔑 <code>{key}</code> - 📝 {_preview_note(note)}"
+             for idx, (key, note) in enumerate(files[:LIST_PAGE_SIZE], offset + 1)]
+    response = (f"📁 您的文件列表（第 {page} 页）：\n\n" + "\n".join(lines)
+                + "\n\n发送密钥可获取文件\n使用 /update [密钥] [新备注] 修改备注")
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"list:{user_id}:{page - 1}"))
+    if len(files) > LIST_PAGE_SIZE:
+        buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"list:{user_id}:{page + 1}"))
+    return response, (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+def _is_valid_page(text):
+    return text.isascii() and text.isdigit() and 1 <= int(text) <= LIST_MAX_PAGE
+
 async def list_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    conn = None
+    args = context.args
+    if len(args) > 1 or (args and not _is_valid_page(args[0])):
+        await update.message.reply_text("⚠️ 格式错误！请使用：/list 或 /list [页码]")
+        return
+    page = int(args[0]) if args else 1
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT key, custom_note FROM files WHERE user_id = ? ORDER BY id DESC", (user_id,))
-        files = cursor.fetchall()
-        if not files:
-            await update.message.reply_text("📭 您还没有存储任何文件")
-            return
-        response = "📁 您的文件列表：\n\n"
-        for idx, (key, note) in enumerate(files, 1):
-            response += f"{idx}. 🔑 <code>{key}</code> - 📝 {note}\n"
-        response += "\n发送密钥可获取文件\n使用 /update [密钥] [新备注] 修改备注"
-        await update.message.reply_text(response, parse_mode=ParseMode.HTML)
+        response, reply_markup = await _render_file_list(context.bot_data["db_pool"], user_id, page)
+        await update.message.reply_text(response, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"数据库查询失败: {e}")
+        logger.error(f"获取文件列表失败: {e}")
         await update.message.reply_text("❌ 无法获取文件列表，请重试")
-    finally:
-        if conn: conn.close()
+
+async def list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, owner_id, page = query.data.split(":")
+    owner_id = int(owner_id)
+    # 群聊里其他人也能看到按钮，只允许列表的主人翻页
+    if query.from_user.id != owner_id:
+        await query.answer("⚠️ 这不是您的文件列表，请发送 /list 查看自己的文件", show_alert=True)
+        return
+    # callback_data 可以被伪造，页码同样要校验
+    if not _is_valid_page(page):
+        await query.answer("⚠️ 页码无效", show_alert=True)
+        return
+    page = int(page)
+    try:
+        response, reply_markup = await _render_file_list(context.bot_data["db_pool"], owner_id, page)
+    except Exception as e:
+        logger.error(f"数据库查询失败: {e}")
+        await query.answer("❌ 无法获取文件列表，请重试")
+        return
+    await query.answer()
+    try:
+        await query.edit_message_text(response, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        # 重复点击同一按钮时内容未变化，Telegram 会拒绝编辑，这种情况可以忽略
+        if "message is not modified" in e.message.lower():
+            logger.debug(f"文件列表翻页未更新: {e}")
+        else:
+            logger.error(f"文件列表翻页失败: {e}")
 
 async def update_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -353,31 +653,25 @@ async def update_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     key = args[0]
     new_note = ' '.join(args[1:])
-    conn = None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, custom_note, channel_msg_id, file_type FROM files WHERE key = ? AND user_id = ?", (key, user_id))
-        file_data = cursor.fetchone()
+        async with context.bot_data["db_pool"].writer() as db:
+            async with db.execute(SQL_UPDATE_NOTE_OWNED, (new_note, key, user_id)) as cursor:
+                file_data = await cursor.fetchone()
+            await db.commit()
         if not file_data:
             await update.message.reply_text("⚠️ 更新失败！文件不存在或您不是该文件的所有者")
             return
-        db_file_id, old_note, channel_msg_id, file_type = file_data
-        cursor.execute("UPDATE files SET custom_note = ? WHERE id = ?", (new_note, db_file_id))
-        conn.commit()
-        if channel_msg_id:
-            try:
-                # 只有当只有一个文件时，尝试编辑标题才最有意义
-                if file_type != 'batch':
-                    await context.bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=channel_msg_id, caption=f"🔑 Key: <code>{key}</code>\n📝 Note: {new_note}", parse_mode=ParseMode.HTML)
-            except Exception as e:
-                logger.warning(f"频道备注更新失败: {e}")
+        # 缓存必须在提交之后失效，否则并发的查询可能把旧数据重新写回缓存
+        _invalidate_key(key)
+        channel_msg_id, file_type = file_data
+        # 只有当只有一个文件时，尝试编辑标题才最有意义
+        if channel_msg_id and file_type != 'batch':
+            # 频道同步放到后台，不让用户等待第二次 Telegram 请求
+            context.application.create_task(_edit_channel_caption(channel_msg_id, key, new_note, context), update=update)
         await update.message.reply_text(f"✅ 备注已更新为: {new_note}")
     except Exception as e:
         logger.error(f"数据库更新失败: {e}")
         await update.message.reply_text("❌ 备注更新失败，请重试")
-    finally:
-        if conn: conn.close()
 
 async def delete_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -386,50 +680,53 @@ async def delete_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ 格式错误！请使用：/delete [密钥]")
         return
     key = args[0]
-    conn = None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT channel_msg_id FROM files WHERE key = ? AND user_id = ?", (key, user_id))
-        result = cursor.fetchone()
+        async with context.bot_data["db_pool"].writer() as db:
+            async with db.execute(SQL_DELETE_OWNED, (key, user_id)) as cursor:
+                result = await cursor.fetchone()
+            await db.commit()
         if not result:
             await update.message.reply_text("⚠️ 删除失败！密钥不存在或您不是该文件的所有者。")
             return
+        _invalidate_key(key)
         channel_msg_id = result[0]
-        cursor.execute("DELETE FROM files WHERE key = ? AND user_id = ?", (key, user_id))
-        conn.commit()
         if channel_msg_id:
-            try:
-                await context.bot.delete_message(chat_id=CHANNEL_ID, message_id=channel_msg_id)
-            except Exception as e:
-                logger.warning(f"无法删除频道消息 {channel_msg_id} (可能已被删除或这是一个批处理): {e}")
+            context.application.create_task(_delete_channel_message(channel_msg_id, context), update=update)
         await update.message.reply_text(f"✅ 密钥 <code>{key}</code> 及其关联文件已成功删除。", parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"删除操作失败: {e}")
         await update.message.reply_text("❌ 删除失败，请稍后重试。")
-    finally:
-        if conn: conn.close()
 
 # --- 程序主入口 ---
 def main():
     """程序主入口函数 (同步)"""
     logger.info("机器人正在启动...")
-    if not init_db(): return
 
-    application = (
+    builder = (
         Application.builder()
         .token(TOKEN)
-        .job_queue(JobQueue())
+        .read_timeout(HTTP_TIMEOUT)
+        .write_timeout(HTTP_TIMEOUT)
+        .pool_timeout(10)
+        # 不同用户的更新并行处理；同一用户的文件仍由 _user_lock 保证顺序
+        .concurrent_updates(True)
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    # 全局每秒 30 条；频道属于负数 chat_id，按群组限额每分钟 20 条；遇到 RetryAfter 自动重试
+    try:
+        builder.rate_limiter(AIORateLimiter(overall_max_rate=30, group_max_rate=20, group_time_period=60, max_retries=3))
+    except RuntimeError:
+        logger.warning("未安装 python-telegram-bot[rate-limiter]，不启用请求限流")
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("list", list_files))
+    application.add_handler(CallbackQueryHandler(list_page_callback, pattern=r"^list:\d+:\d+$"))
     application.add_handler(CommandHandler("update", update_note))
     application.add_handler(CommandHandler("delete", delete_key))
-    application.add_handler(MessageHandler(filters.ALL & (filters.VIDEO | filters.Document.ALL | filters.PHOTO), handle_any_file))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_key))
+    application.add_handler(MessageHandler(FILE_FILTER, handle_any_file))
+    application.add_handler(MessageHandler(KEY_FILTER, handle_key))
 
     logger.info("机器人开始轮询...")
     application.run_polling(drop_pending_updates=True)